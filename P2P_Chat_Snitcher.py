@@ -1,191 +1,347 @@
+import asyncio
+import functools
+import logging
+import os
+import queue
+import selectors
 import socket
-import threading
+import struct
 import sys
-import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from logging.handlers import QueueHandler, QueueListener
 
 active_peers = {}
-peers_lock = threading.Lock()
-shutdown_event = threading.Event()
+peer_by_fd = {}
+client_tasks = set()
+executor = None
+
+log = logging.getLogger("p2p_chat")
+
+# Wire format: every message is a 4-byte big-endian length followed by the payload.
+FRAME_HEADER = struct.Struct(">I")
+MAX_FRAME_SIZE = 1 << 20
+RECV_SIZE = 65536
+
+# Control messages are matched on the raw payload; only chat text gets decoded.
+# The exit check tests the length first so ordinary messages are never lowercased.
+CONNECT_PREFIX = b"CONNECT:"
+EXIT_COMMAND = b"exit"
 
 my_listen_port = None
 team_name = None
 
+def start_logging():
+    """
+    Routes peer log records through a queue: the event loop only enqueues them,
+    and a QueueListener thread formats them and writes them to stdout.
+    Returns the listener so it can be stopped (and flushed) on exit.
+    """
+    records = queue.SimpleQueue()
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter("[%(levelname)s] %(message)s"))
+    log.addHandler(QueueHandler(records))
+    log.setLevel(os.environ.get("P2P_LOG_LEVEL", "DEBUG").upper())
+    log.propagate = False
+    listener = QueueListener(records, handler)
+    listener.start()
+    return listener
+
+@functools.lru_cache(maxsize=1)
 def get_local_ip():
     """
     Attempts to determine the local IP address used for outgoing connections.
-    Useful for sharing with peers.
+    Useful for sharing with peers. The result is cached after the first call.
     """
     s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     try:
         s.connect(('8.8.8.8', 80))
         local_ip = s.getsockname()[0]
     except Exception:
-        local_ip = '127.0.0.1'
+        local_ip = get_hostname_ip()
     finally:
         s.close()
     return local_ip
 
-def handle_client(conn, addr):
+def get_hostname_ip():
+    """
+    Fallback for get_local_ip when there is no route out: returns the first
+    non-loopback IPv4 address our hostname resolves to, or 127.0.0.1.
+    """
+    try:
+        infos = socket.getaddrinfo(socket.gethostname(), None, socket.AF_INET, socket.SOCK_STREAM)
+    except OSError:
+        infos = []
+    for info in infos:
+        ip = info[4][0]
+        if not ip.startswith("127."):
+            return ip
+    return '127.0.0.1'
+
+async def send_frame(sock, message):
+    """
+    Sends a message as a length-prefixed frame.
+    Header and payload go out in one sendmsg() call without being concatenated;
+    only a short write falls back to sock_sendall for the remaining bytes.
+    """
+    loop = asyncio.get_running_loop()
+    payload = message.encode()
+    header = FRAME_HEADER.pack(len(payload))
+    if not hasattr(sock, "sendmsg"):
+        await loop.sock_sendall(sock, header + payload)
+        return
+    try:
+        sent = sock.sendmsg([header, memoryview(payload)])
+    except (BlockingIOError, InterruptedError):
+        sent = 0
+    if sent < len(header) + len(payload):
+        await loop.sock_sendall(sock, memoryview(header + payload)[sent:])
+
+class FrameBuffer:
+    """
+    Per-connection receive buffer that socket reads land in directly.
+    Bytes stay in place until a whole frame is available; only then is the
+    payload copied out. Unread bytes are moved to the front when the tail fills
+    up, and the buffer only grows for a frame larger than its current size.
+    """
+
+    def __init__(self, size=RECV_SIZE):
+        self.buf = bytearray(size)
+        self.view = memoryview(self.buf)
+        self.start = 0
+        self.end = 0
+
+    def free_space(self):
+        """
+        Returns a writable view of the free tail of the buffer for recv_into.
+        """
+        if self.end == len(self.buf):
+            pending = self.end - self.start
+            if self.start:
+                self.view[:pending] = self.buf[self.start:self.end]
+            else:
+                self.buf = self.buf + bytearray(len(self.buf))
+                self.view = memoryview(self.buf)
+            self.start, self.end = 0, pending
+        return self.view[self.end:]
+
+    def frames(self, nbytes):
+        """
+        Accounts for nbytes just received and returns the payloads of every
+        complete frame. A trailing partial frame stays buffered.
+        """
+        self.end += nbytes
+        frames = []
+        while self.end - self.start >= FRAME_HEADER.size:
+            (length,) = FRAME_HEADER.unpack_from(self.buf, self.start)
+            if length > MAX_FRAME_SIZE:
+                raise ValueError(f"frame of {length} bytes exceeds limit")
+            frame_end = self.start + FRAME_HEADER.size + length
+            if frame_end > self.end:
+                break
+            frames.append(bytes(self.view[self.start + FRAME_HEADER.size:frame_end]))
+            self.start = frame_end
+        if self.start == self.end:
+            self.start = self.end = 0
+        return frames
+
+def tune_socket(sock):
+    """
+    Disables Nagle's algorithm so small chat frames go out immediately,
+    and enables TCP keep-alive on the long-lived peer connection.
+    """
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+
+def close_peer(sock):
+    """
+    Shuts down a peer socket. Its handle_client task then reads EOF and closes it,
+    so the socket is never closed underneath a pending sock_recv.
+    """
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+
+def register_peer(peer, sock):
+    """
+    Records sock as the connection for peer, keeping the fd -> peer index in step
+    so teardown can find the entry in O(1) even after a CONNECT rename.
+    Peers are keyed by (ip, listening_port) wherever we know it: the dialed target
+    for outbound sockets, the CONNECT port for inbound ones. send_message looks up
+    the same key, so later messages reuse the open connection instead of redialing.
+    """
+    active_peers[peer] = sock
+    peer_by_fd[sock.fileno()] = peer
+
+def unregister_peer(sock):
+    """
+    Removes whichever active_peers entry currently points at sock.
+    """
+    peer = peer_by_fd.pop(sock.fileno(), None)
+    if peer is not None and active_peers.get(peer) is sock:
+        active_peers.pop(peer)
+
+def spawn_client(conn, addr):
+    """
+    Schedules handle_client for a connection on the running event loop.
+    A reference is kept in client_tasks so the task is not garbage collected.
+    """
+    task = asyncio.get_running_loop().create_task(handle_client(conn, addr))
+    client_tasks.add(task)
+    task.add_done_callback(client_tasks.discard)
+
+async def handle_client(conn, addr):
     """
     Handles messages from a connected peer.
     If the peer sends a "CONNECT:<listening_port>" message, we update our record.
     Note: We update the global peer dictionary but do not change the local 'addr'
     used for printing messages so that the displayed port remains the original connection port.
     """
-    current_peer = addr  
+    loop = asyncio.get_running_loop()
+    current_peer = addr
+    reader = FrameBuffer()
     try:
-        while not shutdown_event.is_set():
-            data = conn.recv(1024)
-            if not data:
-                print(f"[INFO] Connection closed by {current_peer[0]}:{current_peer[1]}")
+        while True:
+            n = await loop.sock_recv_into(conn, reader.free_space())
+            if not n:
+                log.info("Connection closed by %s:%s", current_peer[0], current_peer[1])
                 break
-            message = data.decode().strip()
-            if not message:
-                continue
-
-            if message.startswith("CONNECT:"):
-                try:
-                    sender_listen_port = int(message.split(":", 1)[1])
-                    new_peer = (current_peer[0], sender_listen_port)
-                except ValueError:
-                    print(f"[ERROR] Invalid CONNECT message from {current_peer}")
+
+            for data in reader.frames(n):
+                data = data.strip()
+                if not data:
                     continue
 
-                with peers_lock:
-                    if current_peer in active_peers:
-                        active_peers.pop(current_peer)
+                if data.startswith(CONNECT_PREFIX):
+                    try:
+                        sender_listen_port = int(data[len(CONNECT_PREFIX):])
+                        new_peer = (current_peer[0], sender_listen_port)
+                    except ValueError:
+                        log.error("Invalid CONNECT message from %s", current_peer)
+                        continue
+
+                    unregister_peer(conn)
                     if new_peer in active_peers:
-                        try:
-                            active_peers[new_peer].close()
-                        except Exception:
-                            pass
-                    active_peers[new_peer] = conn
-                print(f"[INFO] Updated connection info for peer {new_peer[0]}:{new_peer[1]}")
-                continue
-
-            if message.lower() == "exit":
-                print(f"[INFO] {current_peer[0]}:{current_peer[1]} sent exit. Disconnecting.")
-                break
+                        close_peer(active_peers[new_peer])
+                    register_peer(new_peer, conn)
+                    log.info("Updated connection info for peer %s:%s", new_peer[0], new_peer[1])
+                    continue
+
+                if len(data) == len(EXIT_COMMAND) and data.lower() == EXIT_COMMAND:
+                    log.info("%s:%s sent exit. Disconnecting.", current_peer[0], current_peer[1])
+                    return
 
-            print(f"\n[Message from {current_peer[0]}:{current_peer[1]}]: {message}")
+                log.info("Message from %s:%s: %s", current_peer[0], current_peer[1], data.decode())
 
     except Exception as e:
-        print(f"[ERROR] Exception with peer {current_peer[0]}:{current_peer[1]}: {e}")
+        log.error("Exception with peer %s:%s: %s", current_peer[0], current_peer[1], e)
     finally:
-        with peers_lock:
-            if current_peer in active_peers:
-                active_peers.pop(current_peer)
+        unregister_peer(conn)
         conn.close()
 
-def server_thread(listen_socket):
+async def server_loop(listen_socket):
     """
-    Accepts incoming connections and spawns a dedicated thread for each client.
+    Accepts incoming connections and schedules a handle_client task for each client.
     """
-    while not shutdown_event.is_set():
+    loop = asyncio.get_running_loop()
+    while True:
         try:
-            listen_socket.settimeout(1.0)
-            conn, addr = listen_socket.accept()
-        except socket.timeout:
-            continue
+            conn, addr = await loop.sock_accept(listen_socket)
         except Exception as e:
-            if not shutdown_event.is_set():
-                print(f"[ERROR] Accept failed: {e}")
+            log.error("Accept failed: %s", e)
             break
 
-        print(f"[INFO] Accepted connection from {addr[0]}:{addr[1]}")
-        with peers_lock:
-            active_peers[addr] = conn
-        client_thread = threading.Thread(target=handle_client, args=(conn, addr), daemon=True)
-        client_thread.start()
+        log.info("Accepted connection from %s:%s", addr[0], addr[1])
+        conn.setblocking(False)
+        tune_socket(conn)
+        register_peer(addr, conn)
+        spawn_client(conn, addr)
 
-def send_message(target_ip, target_port, message):
+async def send_message(target_ip, target_port, message):
     """
     Sends a message to the target peer.
     If no active connection exists, creates a new connection.
     """
+    loop = asyncio.get_running_loop()
     target = (target_ip, target_port)
-    sock = None
-    with peers_lock:
-        sock = active_peers.get(target)
+    sock = active_peers.get(target)
 
     if sock is None:
         try:
             sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock.settimeout(10)
-            print(f"[DEBUG] Attempting to connect to {target_ip}:{target_port}")
-            sock.connect(target)
-            sock.settimeout(None)
-            with peers_lock:
-                active_peers[sock.getpeername()] = sock
-            client_thread = threading.Thread(target=handle_client, args=(sock, sock.getpeername()), daemon=True)
-            client_thread.start()
+            sock.setblocking(False)
+            tune_socket(sock)
+            log.debug("Attempting to connect to %s:%s", target_ip, target_port)
+            await asyncio.wait_for(loop.sock_connect(sock, target), timeout=10)
+            register_peer(target, sock)
+            spawn_client(sock, target)
         except Exception as e:
-            print(f"[ERROR] Could not connect to {target_ip}:{target_port} - {e}")
+            log.error("Could not connect to %s:%s - %s", target_ip, target_port, e)
+            # sock is still None if socket.socket() itself failed (e.g. EMFILE).
+            if sock is not None:
+                sock.close()
             return
 
     try:
-        sock.sendall(message.encode())
-        print(f"[INFO] Message sent to {target_ip}:{target_port}")
-        if message.lower() == "exit":
-            with peers_lock:
-                active_peers.pop(target, None)
-            sock.close()
+        await send_frame(sock, message)
+        log.info("Message sent to %s:%s", target_ip, target_port)
+        if len(message) == 4 and message.lower() == "exit":
+            unregister_peer(sock)
+            close_peer(sock)
     except Exception as e:
-        print(f"[ERROR] Failed to send message: {e}")
-        with peers_lock:
-            active_peers.pop(target, None)
-        sock.close()
+        log.error("Failed to send message: %s", e)
+        unregister_peer(sock)
+        close_peer(sock)
 
-def connect_to_peer(target_ip, target_port):
+async def connect_to_peer(target_ip, target_port):
     """
     Connects to a peer by sending a connection message that includes our listening port.
     """
-    global my_listen_port
+    loop = asyncio.get_running_loop()
     target = (target_ip, target_port)
-    sock = None
-    with peers_lock:
-        sock = active_peers.get(target)
+    sock = active_peers.get(target)
 
     if sock is None:
         try:
             sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock.settimeout(10)
-            print(f"[DEBUG] Attempting to connect to {target_ip}:{target_port}")
-            sock.connect(target)
-            sock.settimeout(None)
-            with peers_lock:
-                active_peers[sock.getpeername()] = sock
-            client_thread = threading.Thread(target=handle_client, args=(sock, sock.getpeername()), daemon=True)
-            client_thread.start()
+            sock.setblocking(False)
+            tune_socket(sock)
+            log.debug("Attempting to connect to %s:%s", target_ip, target_port)
+            await asyncio.wait_for(loop.sock_connect(sock, target), timeout=10)
+            register_peer(target, sock)
+            spawn_client(sock, target)
         except Exception as e:
-            print(f"[ERROR] Could not connect to {target_ip}:{target_port} - {e}")
+            log.error("Could not connect to %s:%s - %s", target_ip, target_port, e)
+            # sock is still None if socket.socket() itself failed (e.g. EMFILE).
+            if sock is not None:
+                sock.close()
             return
 
     connect_msg = f"CONNECT:{my_listen_port}"
     try:
-        sock.sendall(connect_msg.encode())
-        print(f"[INFO] Sent connection message to {target_ip}:{target_port}")
+        await send_frame(sock, connect_msg)
+        log.info("Sent connection message to %s:%s", target_ip, target_port)
     except Exception as e:
-        print(f"[ERROR] Failed to send connection message: {e}")
-        with peers_lock:
-            active_peers.pop(target, None)
-        sock.close()
+        log.error("Failed to send connection message: %s", e)
+        unregister_peer(sock)
+        close_peer(sock)
 
 def query_active_peers():
     """
     Displays the list of active peers.
     """
-    with peers_lock:
-        if active_peers:
-            print("\nConnected Peers:")
-            for i, peer in enumerate(active_peers.keys(), 1):
-                print(f" {i}. {peer[0]}:{peer[1]}")
-        else:
-            print("\nNo connected peers.")
-
-def send_mandatory_messages():
+    if active_peers:
+        print("\nConnected Peers:")
+        for i, peer in enumerate(active_peers.keys(), 1):
+            print(f" {i}. {peer[0]}:{peer[1]}")
+    else:
+        print("\nNo connected peers.")
+
+async def send_mandatory_messages():
     """
     Mandatorily sends a message to the two specified IP/port pairs.
+    The sends run concurrently, so an unreachable peer does not delay the other.
     """
     mandatory_peers = [
         ("10.206.4.201", 1255),
@@ -193,15 +349,146 @@ def send_mandatory_messages():
     ]
     
     for ip, port in mandatory_peers:
-        print(f"[INFO] Attempting to send mandatory message to {ip}:{port}")
+        log.info("Attempting to send mandatory message to %s:%s", ip, port)
+    await asyncio.gather(*(
         send_message(ip, port, f"{team_name}: Mandatory message: Hello from our peer!")
+        for ip, port in mandatory_peers
+    ))
 
-def main():
-    global my_listen_port, team_name
+async def shutdown(server, listen_socket):
+    """
+    Stops accepting, then shuts down every peer socket so each handle_client
+    task reads EOF and closes its connection through the normal path, sending
+    a FIN to the peer. Tasks still running after a second are cancelled.
+    """
+    server.cancel()
+    try:
+        listen_socket.close()
+    except Exception:
+        pass
+    for sock in list(active_peers.values()):
+        close_peer(sock)
+    if client_tasks:
+        _, pending = await asyncio.wait(list(client_tasks), timeout=1)
+        for task in pending:
+            task.cancel()
+    await asyncio.gather(server, *client_tasks, return_exceptions=True)
+    active_peers.clear()
+    peer_by_fd.clear()
+
+def read_line(text):
+    """
+    Writes the prompt and reads one line straight from sys.stdin.
+    Raises EOFError at end of input, like input() does.
+    """
+    sys.stdout.write(text)
+    sys.stdout.flush()
+    line = sys.stdin.readline()
+    if not line:
+        raise EOFError
+    return line
+
+async def prompt(text):
+    """
+    Reads a line from stdin on a daemon thread so the event loop keeps
+    serving peers while the menu waits for input. The thread is a daemon
+    (not an executor worker) so a read still blocked at exit does not keep
+    the process alive after Ctrl+C.
+    """
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+
+    def deliver(result, error):
+        if future.done():
+            return
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def reader():
+        try:
+            result, error = read_line(text), None
+        except Exception as e:
+            result, error = None, e
+        try:
+            loop.call_soon_threadsafe(deliver, result, error)
+        except RuntimeError:
+            pass  # The loop closed while we were waiting for input.
 
-    team_name = input("Enter your team name: ").strip()
+    threading.Thread(target=reader, daemon=True).start()
+    return (await future).strip()
+
+async def menu_send():
+    """
+    Menu option 1: prompts for a recipient and message, then sends it.
+    """
+    target_ip = await prompt("Enter the recipient's IP address: ")
+    try:
+        target_port = int(await prompt("Enter the recipient's port number: "))
+    except ValueError:
+        print("[ERROR] Invalid port number.")
+        return
+    message = await prompt("Enter your message (type 'exit' to disconnect): ")
+    await send_message(target_ip, target_port, f"{team_name}: {message}")
+
+async def menu_query():
+    """
+    Menu option 2: lists the connected peers.
+    """
+    query_active_peers()
+
+async def menu_connect():
+    """
+    Menu option 3: prompts for a peer address and sends it our CONNECT message.
+    """
+    target_ip = await prompt("Enter the peer's IP address to connect: ")
     try:
-        my_listen_port = int(input("Enter your port number (for incoming connections): ").strip())
+        target_port = int(await prompt("Enter the peer's port number: "))
+    except ValueError:
+        print("[ERROR] Invalid port number.")
+        return
+    await connect_to_peer(target_ip, target_port)
+
+async def menu_quit():
+    """
+    Menu option 0: returns True so the menu loop exits and shutdown runs.
+    """
+    print("Exiting...")
+    return True
+
+async def menu_invalid():
+    """
+    Handles any choice that is not on the menu.
+    """
+    print("[ERROR] Invalid choice. Please try again.")
+
+MENU_TEXT = """
+***** Menu *****
+1. Send message
+2. Query active peers
+3. Connect to a peer
+0. Quit"""
+
+# Menu choice -> handler; a handler returning True ends the menu loop.
+MENU_HANDLERS = {
+    "1": menu_send,
+    "2": menu_query,
+    "3": menu_connect,
+    "0": menu_quit,
+}
+
+async def main():
+    global my_listen_port, team_name, executor
+
+    log_listener = start_logging()
+    # Peer I/O never needs a thread; the pool only backs blocking calls such as DNS lookups.
+    executor = ThreadPoolExecutor(max_workers=int(os.environ.get("P2P_MAX_WORKERS", "2")))
+    asyncio.get_running_loop().set_default_executor(executor)
+
+    team_name = await prompt("Enter your team name: ")
+    try:
+        my_listen_port = int(await prompt("Enter your port number (for incoming connections): "))
     except ValueError:
         print("[ERROR] Invalid port number. Exiting.")
         sys.exit(1)
@@ -218,67 +505,43 @@ def main():
         print(f"[ERROR] Could not bind to port {my_listen_port}: {e}")
         sys.exit(1)
 
-    listen_socket.listen(5)
+    # A full-size accept queue, so a burst of connecting peers is not refused.
+    listen_socket.listen(socket.SOMAXCONN)
+    listen_socket.setblocking(False)
     print(f"Server listening on port {my_listen_port}...")
 
-    server = threading.Thread(target=server_thread, args=(listen_socket,), daemon=True)
-    server.start()
-
-    time.sleep(2)
-    send_mandatory_messages()
-
-    while True:
-        print("\n***** Menu *****")
-        print("1. Send message")
-        print("2. Query active peers")
-        print("3. Connect to a peer")
-        print("0. Quit")
-        choice = input("Enter choice: ").strip()
-
-        if choice == "1":
-            target_ip = input("Enter the recipient's IP address: ").strip()
-            try:
-                target_port = int(input("Enter the recipient's port number: ").strip())
-            except ValueError:
-                print("[ERROR] Invalid port number.")
-                continue
-            message = input("Enter your message (type 'exit' to disconnect): ").strip()
-            send_message(target_ip, target_port, f"{team_name}: {message}")
-
-        elif choice == "2":
-            query_active_peers()
-
-        elif choice == "3":
-            target_ip = input("Enter the peer's IP address to connect: ").strip()
-            try:
-                target_port = int(input("Enter the peer's port number: ").strip())
-            except ValueError:
-                print("[ERROR] Invalid port number.")
-                continue
-            connect_to_peer(target_ip, target_port)
-
-        elif choice == "0":
-            print("Exiting...")
-            shutdown_event.set()
-            break
-
-        else:
-            print("[ERROR] Invalid choice. Please try again.")
-
-    with peers_lock:
-        for peer, sock in list(active_peers.items()):
-            try:
-                sock.close()
-            except Exception:
-                pass
-        active_peers.clear()
+    server = asyncio.create_task(server_loop(listen_socket))
     try:
-        listen_socket.close()
-    except Exception:
-        pass
+        await asyncio.sleep(2)
+        await send_mandatory_messages()
+
+        while True:
+            print(MENU_TEXT)
+            choice = await prompt("Enter choice: ")
+            if await MENU_HANDLERS.get(choice, menu_invalid)():
+                break
+    finally:
+        await shutdown(server, listen_socket)
+        executor.shutdown(wait=False)
+        log_listener.stop()
 
-    server.join(timeout=2)
     print("Goodbye!")
 
 if __name__ == "__main__":
-    main()
+    # Pin the loop to selectors.DefaultSelector (epoll on Linux, kqueue on BSD/macOS)
+    # so the accept loop sleeps in the kernel until a peer connects.
+    loop = asyncio.SelectorEventLoop(selectors.DefaultSelector())
+    asyncio.set_event_loop(loop)
+    main_task = loop.create_task(main())
+    try:
+        loop.run_until_complete(main_task)
+    except KeyboardInterrupt:
+        # Cancel main() and let it finish, so its finally block shuts the
+        # peers down before the loop is closed.
+        main_task.cancel()
+        try:
+            loop.run_until_complete(main_task)
+        except asyncio.CancelledError:
+            pass
+    finally:
+        loop.close()
@@ -1,40 +1,191 @@
+import asyncio
+import collections
+import functools
+import gzip
+import itertools
+import json
+import logging
+import os
+import queue
+import selectors
+import signal
 import socket
+import struct
 import threading
 import sys
 import time
-from flask import Flask, request, jsonify, render_template_string, redirect, url_for
+import weakref
+from logging.handlers import QueueHandler, QueueListener
+from flask import Flask, Response, request, render_template, redirect, url_for
+
+try:
+    from waitress import serve as waitress_serve
+except ImportError:
+    waitress_serve = None
+
+# orjson serializes straight to UTF-8 bytes and is several times faster than json.
+try:
+    import orjson
+    dump_json = orjson.dumps
+except ImportError:
+    def dump_json(obj):
+        return json.dumps(obj).encode()
 
 ###############################################
-# Global variables and locks for peer networking
+# Global variables for peer networking
 ###############################################
 
-# Active peers dictionary: key=(peer_ip, peer_port), value=socket object
-active_peers = {}
-peers_lock = threading.Lock()
+# Wire format: every message is a 4-byte network-order length followed by the payload.
+FRAME_HEADER = struct.Struct("!I")
+MAX_FRAME_SIZE = 1 << 20
+# Most frames written to a connection with a single writelines() call.
+MAX_SEND_BATCH = 32
+
+# Control messages are matched on the raw payload, before decoding.
+CONNECT_PREFIX = b"CONNECT:"
+EXIT_COMMAND = b"exit"
+
+# Worker threads for the web server. Each open /stream connection holds a
+# thread for as long as it is open, so streams are capped at MAX_STREAMS and
+# get their own share of the pool on top of the threads for ordinary requests.
+MAX_STREAMS = 8
+REQUEST_THREADS = 16
+WEB_THREADS = MAX_STREAMS + REQUEST_THREADS
+
+# Seconds between keep-alive comments on an idle /stream connection.
+STREAM_KEEPALIVE = 10
 
-# Event to signal shutdown.
-shutdown_event = threading.Event()
+# Limits for the outbound connection pool.
+MAX_PEER_CONNECTIONS = 64
+PEER_IDLE_TTL = 600  # seconds
+
+# Peers we connect to at startup; their connections are kept open.
+MANDATORY_PEERS = [
+    ("10.206.4.122", 1255),
+    ("10.206.5.228", 6555)
+]
+PREWARM_ATTEMPTS = 4
+PREWARM_BACKOFF = 1  # seconds before the first retry; doubles each time
+
+# Event loop that owns every peer connection; it runs in its own thread and
+# Flask routes hand work to it with run_on_peer_loop().
+peer_loop = None
+client_tasks = set()
+log = logging.getLogger("p2p_chat")
+
+# Frames waiting to be written, per connection (see send_frame()).
+pending_frames = {}
 
 # Global variables for our listening port and team name.
 my_listen_port = None
 team_name = None
 
-# Chat history list to store messages (each is a dict with sender, message, timestamp)
-chat_history = []
-chat_lock = threading.Lock()
+# Chat history ring buffer (each entry is a dict with sender, message, timestamp).
+# Only the newest CHAT_HISTORY_SIZE messages are kept. Appends happen under
+# updates_cond so entries land in sequence order; list(deque) is a single
+# C-level operation under the GIL, so readers need no lock.
+CHAT_HISTORY_SIZE = 2048
+chat_history = collections.deque(maxlen=CHAT_HISTORY_SIZE)
+
+# Every message gets an increasing sequence number so /stream clients are sent
+# only the messages they have not seen yet.
+chat_seq = itertools.count()
+
+# One slot per open /stream connection; requests beyond MAX_STREAMS get a 503.
+stream_slots = threading.BoundedSemaphore(MAX_STREAMS)
+
+# Signalled whenever a chat message arrives or the peer set changes; /stream
+# generators wait on it instead of the browser polling /updates.
+updates_cond = threading.Condition()
+
+class UpdatesCache:
+    """
+    The serialized /updates response body. It is rebuilt on the first read
+    after chat history or the peer set changes, so concurrent readers share
+    one serialization instead of each encoding the whole history.
+    """
+
+    def __init__(self):
+        self.version = 0
+        self.body_version = -1
+        self.body = b""
+        self.lock = threading.Lock()
+
+    def invalidate(self):
+        """Called with updates_cond held, which serializes the increments."""
+        self.version += 1
+
+    def get_bytes(self):
+        if self.body_version != self.version:
+            with self.lock:
+                version = self.version
+                if self.body_version != version:
+                    self.body = dump_json({
+                        "chat_history": list(chat_history),
+                        "active_peers": active_peers.display
+                    })
+                    self.body_version = version
+        return self.body
+
+updates_cache = UpdatesCache()
+
+def notify_updates():
+    """Marks /updates stale and wakes every /stream client to push the new state."""
+    with updates_cond:
+        updates_cache.invalidate()
+        updates_cond.notify_all()
+
+# (second, "HH:MM:SS") for the most recent timestamp; messages arriving within
+# the same second reuse the formatted string.
+last_timestamp = (0, "")
+
+def current_timestamp():
+    """Returns the local time as HH:MM:SS, formatting it at most once per second."""
+    global last_timestamp
+    now = int(time.time())
+    if now != last_timestamp[0]:
+        last_timestamp = (now, time.strftime('%H:%M:%S', time.localtime(now)))
+    return last_timestamp[1]
 
 def add_chat_message(sender, message):
-    """Thread-safe addition of a chat message."""
-    with chat_lock:
+    """
+    Thread-safe addition of a chat message. The sequence number is taken and
+    the entry appended under one lock, so chat_history stays in seq order,
+    which /stream relies on to never skip a message.
+    """
+    timestamp = current_timestamp()
+    with updates_cond:
         chat_history.append({
+            'seq': next(chat_seq),
             'sender': sender,
             'message': message,
-            'timestamp': time.strftime('%H:%M:%S')
+            'timestamp': timestamp
         })
+        updates_cache.invalidate()
+        updates_cond.notify_all()
 
+def start_logging():
+    """
+    Routes peer log records through a queue: the event loop only enqueues them,
+    and a QueueListener thread formats them and writes them to stdout.
+    Returns the listener so it can be stopped (and flushed) on exit.
+    """
+    records = queue.SimpleQueue()
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter("[%(levelname)s] %(message)s"))
+    log.addHandler(QueueHandler(records))
+    log.setLevel(os.environ.get("P2P_LOG_LEVEL", "DEBUG").upper())
+    log.propagate = False
+    listener = QueueListener(records, handler)
+    listener.start()
+    return listener
+
+@functools.lru_cache(maxsize=1)
 def get_local_ip():
     """
     Determines the local IP address used for outgoing connections.
+    The result is cached after the first call; get_local_ip.cache_clear()
+    forgets it, e.g. after a network interface change.
     """
     s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     try:
@@ -46,173 +197,431 @@ def get_local_ip():
         s.close()
     return local_ip
 
+class PeerPool:
+    """
+    Registry of open peer connections, keyed by (peer_ip, peer_port).
+    Each peer keeps one connection that is reused for every message instead of
+    being redialed. Connections idle for longer than idle_ttl are closed, and
+    at most max_connections are kept open (the least recently used go first).
+    Peers in `pinned` are exempt from both.
+    Only the peer event loop mutates the pool, so it needs no thread lock.
+    Other threads read the immutable `display` tuple of "ip:port" strings,
+    which is rebuilt on every change. Concurrent dials to the same peer are
+    coalesced by a per-peer asyncio.Lock that disappears once no dial is
+    using it.
+    """
+
+    def __init__(self, max_connections=MAX_PEER_CONNECTIONS, idle_ttl=PEER_IDLE_TTL):
+        self.max_connections = max_connections
+        self.idle_ttl = idle_ttl
+        self.writers = {}
+        self.last_used = {}
+        self.dial_locks = weakref.WeakValueDictionary()
+        self.pinned = set()
+        self.labels = {}
+        self.display = ()
+
+    def __contains__(self, peer):
+        return peer in self.writers
+
+    def get(self, peer):
+        return self.writers.get(peer)
+
+    def publish(self):
+        """Rebuilds the display tuple read by other threads and wakes /stream clients."""
+        self.display = tuple(self.labels.values())
+        notify_updates()
+
+    def register(self, peer, writer):
+        """
+        Records writer as the connection for peer, closing the least recently
+        used connection if the pool is full.
+        """
+        self.writers[peer] = writer
+        self.labels[peer] = f"{peer[0]}:{peer[1]}"
+        self.last_used[peer] = time.monotonic()
+        self.publish()
+        if len(self.writers) > self.max_connections:
+            oldest = min((p for p in self.last_used if p not in self.pinned),
+                         key=self.last_used.get, default=None)
+            if oldest is not None:
+                self.discard(oldest)
+
+    def unregister(self, peer, writer=None):
+        """
+        Forgets peer, but only if it still maps to writer (when one is given).
+        """
+        if writer is not None and self.writers.get(peer) is not writer:
+            return
+        if self.writers.pop(peer, None) is not None:
+            del self.labels[peer]
+            self.publish()
+        self.last_used.pop(peer, None)
+
+    def discard(self, peer, writer=None):
+        """
+        Forgets peer and closes its connection.
+        """
+        writer = writer or self.writers.get(peer)
+        self.unregister(peer, writer)
+        if writer is not None:
+            writer.close()
+
+    async def acquire(self, target):
+        """
+        Returns a live connection to target, dialing one if none is open.
+        Returns None if the peer cannot be reached.
+        """
+        writer = self.writers.get(target)
+        if writer is not None and not writer.is_closing():
+            return writer
+        lock = self.dial_locks.setdefault(target, asyncio.Lock())
+        async with lock:
+            writer = self.writers.get(target)
+            if writer is None or writer.is_closing():
+                writer = await open_peer(*target)
+        return writer
+
+    def release(self, target):
+        """
+        Marks target's connection as just used; it stays open for the next message.
+        """
+        if target in self.last_used:
+            self.last_used[target] = time.monotonic()
+
+    async def reap_idle(self):
+        """
+        Periodically closes connections that have been idle longer than idle_ttl.
+        """
+        while True:
+            await asyncio.sleep(self.idle_ttl / 2)
+            deadline = time.monotonic() - self.idle_ttl
+            for peer, used in list(self.last_used.items()):
+                if used < deadline and peer not in self.pinned:
+                    log.info("Closing idle connection to %s:%s", peer[0], peer[1])
+                    self.discard(peer)
+
+    def close_all(self):
+        for writer in list(self.writers.values()):
+            writer.close()
+        self.writers.clear()
+        self.last_used.clear()
+        self.labels.clear()
+        self.publish()
+
+active_peers = PeerPool()
+
+class PeerSession:
+    """
+    Tracks which pool key a connection is filed under while handle_client
+    reads from it. On exit the connection is removed from the pool (if it
+    is still the one registered for that key) and closed.
+    """
+
+    def __init__(self, peer, writer):
+        self.peer = peer
+        self.label = f"{peer[0]}:{peer[1]}"
+        self.writer = writer
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        active_peers.discard(self.peer, self.writer)
+
+    def rename(self, new_peer):
+        """
+        Re-files the connection under new_peer, replacing any other
+        connection to that peer.
+        """
+        active_peers.unregister(self.peer, self.writer)
+        if new_peer in active_peers:
+            active_peers.discard(new_peer)
+        active_peers.register(new_peer, self.writer)
+        self.peer = new_peer
+        self.label = f"{new_peer[0]}:{new_peer[1]}"
+
+def run_on_peer_loop(coro):
+    """
+    Schedules a coroutine on the peer event loop from any other thread.
+    Returns a concurrent.futures.Future for its result.
+    """
+    return asyncio.run_coroutine_threadsafe(coro, peer_loop)
+
 ###############################################
 # Peer-to-peer socket functions
 ###############################################
 
-def handle_client(conn, addr):
+async def send_frame(writer, message):
+    """
+    Sends a message on writer as a length-prefixed frame.
+    Frames sent by other tasks while a drain is in progress are batched:
+    the whole batch is written with one writelines() and one drain().
+    Raises whatever the write raised if the batch could not be sent.
+    """
+    payload = message.encode()
+    sent = asyncio.get_running_loop().create_future()
+    batch = pending_frames.get(writer)
+    if batch is None:
+        batch = pending_frames[writer] = []
+        spawn_task(flush_frames(writer, batch))
+    batch.append((FRAME_HEADER.pack(len(payload)), payload, sent))
+    await sent
+
+async def flush_frames(writer, batch):
+    """
+    Writes queued frames for one connection until none are left, then exits.
+    """
+    frames = []
+    try:
+        while batch:
+            frames = batch[:MAX_SEND_BATCH]
+            del batch[:MAX_SEND_BATCH]
+            try:
+                writer.writelines([part for header, payload, _ in frames for part in (header, payload)])
+                await writer.drain()
+            except Exception as e:
+                for _, _, sent in frames:
+                    if not sent.done():
+                        sent.set_exception(e)
+            else:
+                for _, _, sent in frames:
+                    if not sent.done():
+                        sent.set_result(None)
+    finally:
+        # Only reached with frames left over if the task was cancelled.
+        del pending_frames[writer]
+        for _, _, sent in frames + batch:
+            sent.cancel()
+
+async def read_frame(reader):
+    """
+    Reads one length-prefixed frame and returns its payload.
+    Returns None if the peer closed the connection between frames.
+    """
+    try:
+        header = await reader.readexactly(FRAME_HEADER.size)
+    except asyncio.IncompleteReadError as e:
+        if not e.partial:
+            return None
+        raise
+    (length,) = FRAME_HEADER.unpack(header)
+    if length > MAX_FRAME_SIZE:
+        raise ValueError(f"frame of {length} bytes exceeds limit")
+    return await reader.readexactly(length)
+
+def spawn_task(coro):
+    """
+    Starts coro as a task on the peer event loop.
+    A reference is kept in client_tasks so the task is not garbage collected,
+    and so shutdown can cancel it.
+    """
+    task = asyncio.get_running_loop().create_task(coro)
+    client_tasks.add(task)
+    task.add_done_callback(client_tasks.discard)
+    return task
+
+def spawn_client(reader, writer, addr):
+    """
+    Starts a handle_client task for a connection on the peer event loop.
+    """
+    spawn_task(handle_client(reader, writer, addr))
+
+async def handle_client(reader, writer, addr):
     """
     Handles messages from a connected peer.
     If the peer sends a "CONNECT:<listening_port>" message, we update our record.
     Also, non-control messages are added to the chat history.
     """
-    global active_peers
-    current_peer = addr
-    try:
-        while not shutdown_event.is_set():
-            data = conn.recv(1024)
-            if not data:
-                print(f"[INFO] Connection closed by {current_peer[0]}:{current_peer[1]}")
-                break
-            message = data.decode().strip()
-            if not message:
-                continue
+    with PeerSession(addr, writer) as session:
+        try:
+            while True:
+                data = await read_frame(reader)
+                if data is None:
+                    log.info("Connection closed by %s", session.label)
+                    break
+                data = data.strip()
+                if not data:
+                    continue
 
-            # Handle a connection update message.
-            if message.startswith("CONNECT:"):
-                try:
-                    sender_listen_port = int(message.split(":", 1)[1])
-                    new_peer = (current_peer[0], sender_listen_port)
-                except ValueError:
-                    print(f"[ERROR] Invalid CONNECT message from {current_peer}")
+                # Handle a connection update message.
+                if data.startswith(CONNECT_PREFIX):
+                    try:
+                        sender_listen_port = int(data[len(CONNECT_PREFIX):])
+                    except ValueError:
+                        log.error("Invalid CONNECT message from %s", session.label)
+                        continue
+                    session.rename((session.peer[0], sender_listen_port))
+                    log.info("Updated connection info for peer %s", session.label)
                     continue
 
-                with peers_lock:
-                    if current_peer in active_peers:
-                        active_peers.pop(current_peer, None)
-                    if new_peer in active_peers:
-                        try:
-                            active_peers[new_peer].close()
-                        except Exception:
-                            pass
-                    active_peers[new_peer] = conn
-                current_peer = new_peer
-                print(f"[INFO] Updated connection info for peer {new_peer[0]}:{new_peer[1]}")
-                continue
+                # If a peer sends "exit", then disconnect.
+                if len(data) == len(EXIT_COMMAND) and data.lower() == EXIT_COMMAND:
+                    log.info("%s sent exit. Disconnecting.", session.label)
+                    break
 
-            # If a peer sends "exit", then disconnect.
-            if message.lower() == "exit":
-                print(f"[INFO] {current_peer[0]}:{current_peer[1]} sent exit. Disconnecting.")
-                break
+                active_peers.release(session.peer)
+                # Only chat text needs to be decoded.
+                message = data.decode()
+                # Log the received message.
+                log.info("Message from %s: %s", session.label, message)
+                add_chat_message(session.label, message)
 
-            # Log the received message.
-            print(f"[Message from {current_peer[0]}:{current_peer[1]}]: {message}")
-            add_chat_message(f"{current_peer[0]}:{current_peer[1]}", message)
+        except Exception as e:
+            log.error("Exception with peer %s: %s", session.label, e)
 
-    except Exception as e:
-        print(f"[ERROR] Exception with peer {current_peer[0]}:{current_peer[1]}: {e}")
-    finally:
-        with peers_lock:
-            if current_peer in active_peers:
-                active_peers.pop(current_peer, None)
-        conn.close()
+def tune_connection(writer):
+    """
+    Disables Nagle's algorithm and enables TCP keep-alive on a peer connection.
+    """
+    sock = writer.get_extra_info("socket")
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
 
-def server_thread(listen_socket):
+async def accept_client(reader, writer):
     """
-    Accept incoming connections and spawn a dedicated thread for each.
+    asyncio.start_server callback for each incoming peer connection.
     """
-    while not shutdown_event.is_set():
-        try:
-            listen_socket.settimeout(1.0)
-            conn, addr = listen_socket.accept()
-        except socket.timeout:
-            continue
-        except Exception as e:
-            if not shutdown_event.is_set():
-                print(f"[ERROR] Accept failed: {e}")
-            break
+    addr = writer.get_extra_info("peername")[:2]
+    log.info("Accepted connection from %s:%s", addr[0], addr[1])
+    tune_connection(writer)
+    active_peers.register(addr, writer)
+    spawn_client(reader, writer, addr)
 
-        print(f"[INFO] Accepted connection from {addr[0]}:{addr[1]}")
-        with peers_lock:
-            active_peers[addr] = conn
-        client_thread = threading.Thread(target=handle_client, args=(conn, addr), daemon=True)
-        client_thread.start()
+async def serve():
+    """
+    Starts accepting peer connections on our listening port, along with the
+    task that closes idle pooled connections.
+    """
+    server = await asyncio.start_server(accept_client, "0.0.0.0", my_listen_port)
+    spawn_task(active_peers.reap_idle())
+    return server
 
-def send_message(target_ip, target_port, message):
+async def open_peer(target_ip, target_port):
     """
-    Sends a message to the target peer.
-    If no active connection exists, creates a new connection.
+    Dials a peer, announces our listening port, then registers the connection
+    under (target_ip, target_port) and starts reading from it.
+    Every dial in the app goes through here (via PeerPool.acquire).
+    Returns the StreamWriter, or None if the connection failed.
     """
     target = (target_ip, target_port)
-    sock = None
-    with peers_lock:
-        sock = active_peers.get(target)
+    try:
+        log.debug("Attempting to connect to %s:%s", target_ip, target_port)
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(target_ip, target_port), timeout=10)  # 10-second timeout for connecting.
+    except Exception as e:
+        log.error("Could not connect to %s:%s - %s", target_ip, target_port, e)
+        return None
+    tune_connection(writer)
+    # Handshake before the connection is shared: the peer files it under our
+    # listening port, so its replies reuse this connection instead of dialing back.
+    try:
+        await send_frame(writer, f"CONNECT:{my_listen_port}")
+    except Exception as e:
+        log.error("Failed to send connection message: %s", e)
+        writer.close()
+        return None
+    active_peers.register(target, writer)
+    # Start a task to handle incoming messages from this new connection
+    spawn_client(reader, writer, target)
+    return writer
 
-    if sock is None:
+async def send_message(target_ip, target_port, message):
+    """
+    Sends a message to the target peer over its pooled connection.
+    If no active connection exists, creates a new connection. If the pooled
+    connection turns out to be dead, it is discarded and the send is retried
+    once on a fresh one.
+    """
+    target = (target_ip, target_port)
+    for attempt in range(2):
+        writer = await active_peers.acquire(target)
+        if writer is None:
+            return
         try:
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock.settimeout(10)  # 10-second timeout for connecting.
-            print(f"[DEBUG] Attempting to connect to {target_ip}:{target_port}")
-            sock.connect(target)
-            sock.settimeout(None)
-            with peers_lock:
-                active_peers[sock.getpeername()] = sock
-            # Start a thread to handle incoming messages from this new connection
-            client_thread = threading.Thread(target=handle_client, args=(sock, sock.getpeername()), daemon=True)
-            client_thread.start()
+            await send_frame(writer, message)
+        except (BrokenPipeError, ConnectionResetError) as e:
+            active_peers.discard(target, writer)
+            if attempt == 0:
+                continue
+            log.error("Failed to send message: %s", e)
+            return
         except Exception as e:
-            print(f"[ERROR] Could not connect to {target_ip}:{target_port} - {e}")
+            log.error("Failed to send message: %s", e)
+            active_peers.discard(target, writer)
             return
 
-    try:
-        sock.sendall(message.encode())
-        print(f"[INFO] Message sent to {target_ip}:{target_port}")
+        log.info("Message sent to %s:%s", target_ip, target_port)
         if message.lower() == "exit":
-            with peers_lock:
-                active_peers.pop(target, None)
-            sock.close()
-    except Exception as e:
-        print(f"[ERROR] Failed to send message: {e}")
-        with peers_lock:
-            active_peers.pop(target, None)
-        sock.close()
+            active_peers.discard(target, writer)
+        else:
+            active_peers.release(target)
+        return
 
-def connect_to_peer(target_ip, target_port):
+async def connect_to_peer(target_ip, target_port):
     """
     Connects to a peer by sending a connection message that includes our listening port.
     """
-    global my_listen_port
     target = (target_ip, target_port)
-    sock = None
-    with peers_lock:
-        sock = active_peers.get(target)
-
-    if sock is None:
-        try:
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock.settimeout(10)
-            print(f"[DEBUG] Attempting to connect to {target_ip}:{target_port}")
-            sock.connect(target)
-            sock.settimeout(None)
-            with peers_lock:
-                active_peers[sock.getpeername()] = sock
-            client_thread = threading.Thread(target=handle_client, args=(sock, sock.getpeername()), daemon=True)
-            client_thread.start()
-        except Exception as e:
-            print(f"[ERROR] Could not connect to {target_ip}:{target_port} - {e}")
-            return
+    writer = active_peers.get(target)
+    if writer is None or writer.is_closing():
+        # Dialing already performs the CONNECT handshake.
+        if await active_peers.acquire(target) is not None:
+            log.info("Sent connection message to %s:%s", target_ip, target_port)
+        return
 
     connect_msg = f"CONNECT:{my_listen_port}"
     try:
-        sock.sendall(connect_msg.encode())
-        print(f"[INFO] Sent connection message to {target_ip}:{target_port}")
+        await send_frame(writer, connect_msg)
+        log.info("Sent connection message to %s:%s", target_ip, target_port)
     except Exception as e:
-        print(f"[ERROR] Failed to send connection message: {e}")
-        with peers_lock:
-            active_peers.pop(target, None)
-        sock.close()
+        log.error("Failed to send connection message: %s", e)
+        active_peers.discard(target, writer)
+
+async def prewarm_peer(ip, port):
+    """
+    Opens a pooled connection to a peer, retrying with exponential backoff.
+    The connection is pinned so the idle reaper leaves it open.
+    Returns True once connected.
+    """
+    target = (ip, port)
+    active_peers.pinned.add(target)
+    delay = PREWARM_BACKOFF
+    for attempt in range(PREWARM_ATTEMPTS):
+        if await active_peers.acquire(target) is not None:
+            return True
+        if attempt < PREWARM_ATTEMPTS - 1:
+            await asyncio.sleep(delay)
+            delay *= 2
+    active_peers.pinned.discard(target)
+    return False
 
-def send_mandatory_messages():
+async def send_mandatory_message(ip, port):
     """
-    Sends a mandatory message to two specified IP/port pairs (optional).
+    Prewarms a connection to one mandatory peer and, once it is up, sends the
+    greeting over it. This is the only place a successful prewarm leads to a
+    message; if the peer never answers, nothing is sent.
     """
-    mandatory_peers = [
-        ("10.206.4.122", 1255),
-        ("10.206.5.228", 6555)
-    ]
-    for ip, port in mandatory_peers:
-        print(f"[INFO] Attempting to send mandatory message to {ip}:{port}")
-        send_message(ip, port, "Mandatory message: Hello from our peer!")
+    if await prewarm_peer(ip, port):
+        log.info("Attempting to send mandatory message to %s:%s", ip, port)
+        await send_message(ip, port, "Mandatory message: Hello from our peer!")
+
+async def send_mandatory_messages():
+    """
+    Sends a mandatory message to each of MANDATORY_PEERS (optional).
+    Runs in the background at startup, so the web interface does not wait for it.
+    """
+    await asyncio.gather(*(send_mandatory_message(ip, port) for ip, port in MANDATORY_PEERS))
+
+async def close_all_peers(server):
+    """
+    Stops accepting and closes every peer connection.
+    """
+    server.close()
+    active_peers.close_all()
+    for task in list(client_tasks):
+        task.cancel()
+    await asyncio.gather(*client_tasks, return_exceptions=True)
 
 ###############################################
 # Flask application and routes
@@ -220,12 +629,11 @@ def send_mandatory_messages():
 
 app = Flask(__name__)
 
-# A helper to shut down the Flask server from a route
+# A helper to shut down the web server from a route. Raising SIGINT in the main
+# thread stops waitress (or the Werkzeug fallback) the same way Ctrl+C does, and
+# main() then closes every peer connection. The short delay lets the response go out.
 def shutdown_server():
-    func = request.environ.get('werkzeug.server.shutdown')
-    if func is None:
-        raise RuntimeError("Not running with the Werkzeug Server")
-    func()
+    threading.Timer(0.5, signal.raise_signal, args=(signal.SIGINT,)).start()
 
 html_template = """
 <!DOCTYPE html>
@@ -427,7 +835,7 @@ html_template = """
     <!-- Left: Peer Connection Section -->
     <div class="peers-section">
       <h2>Peer Connection</h2>
-      <div class="net-frequency">Net Frequency: 3s</div>
+      <div class="net-frequency">Net Frequency: Live</div>
       <!-- Connect to Peer Form -->
       <form id="connectPeerForm" method="POST" action="{{ url_for('connect') }}">
         <label>Peer IP</label>
@@ -485,51 +893,100 @@ html_template = """
       chatPort.value = port;
     }
 
-    // Function to fetch updates (chat history and active peers)
-    function fetchUpdates() {
-      fetch('{{ url_for("updates") }}')
-        .then(response => response.json())
-        .then(data => {
-          // Update chat history
-          const chatDiv = document.getElementById("chatHistory");
-          chatDiv.innerHTML = "";
-          data.chat_history.forEach(msg => {
-            const p = document.createElement("p");
-            p.innerHTML = "<strong>[" + msg.timestamp + "] " + msg.sender + ":</strong> " + msg.message;
-            chatDiv.appendChild(p);
-          });
-          chatDiv.scrollTop = chatDiv.scrollHeight;
-          
-          // Update active peers list
-          const peersList = document.getElementById("peersList");
-          peersList.innerHTML = "";
-          
-          data.active_peers.forEach(peer => {
-            // Add to peer list with a message icon
-            const div = document.createElement("div");
-            div.className = "peer-item";
-            div.innerHTML = `
-              <span>${peer}</span>
-              <button type="button" class="msg-btn" onclick="fillChatFields('${peer}')">💬</button>
-            `;
-            peersList.appendChild(div);
-          });
-        })
-        .catch(err => console.error("Error fetching updates:", err));
+    const chatDiv = document.getElementById("chatHistory");
+    const peersList = document.getElementById("peersList");
+
+    let lastSeq = -1;
+
+    // Append newly received chat messages
+    function appendChat(messages) {
+      messages.forEach(msg => {
+        if (msg.seq <= lastSeq) {
+          return;
+        }
+        lastSeq = msg.seq;
+        const p = document.createElement("p");
+        p.innerHTML = "<strong>[" + msg.timestamp + "] " + msg.sender + ":</strong> " + msg.message;
+        chatDiv.appendChild(p);
+      });
+      if (messages.length) {
+        chatDiv.scrollTop = chatDiv.scrollHeight;
+      }
     }
-    
-    // Poll updates every 3 seconds.
-    setInterval(fetchUpdates, 3000);
-    // Also fetch once when the page loads.
-    fetchUpdates();
+
+    // Replace the active peers list
+    function renderPeers(peers) {
+      peersList.innerHTML = "";
+      peers.forEach(peer => {
+        // Add to peer list with a message icon
+        const div = document.createElement("div");
+        div.className = "peer-item";
+        div.innerHTML = `
+          <span>${peer}</span>
+          <button type="button" class="msg-btn" onclick="fillChatFields('${peer}')">💬</button>
+        `;
+        peersList.appendChild(div);
+      });
+    }
+
+    // The server pushes new chat messages, plus the peer list whenever it changes.
+    // EventSource reconnects on its own and resumes from the last event id.
+    const stream = new EventSource('{{ url_for("stream") }}');
+    stream.onmessage = function(event) {
+      const data = JSON.parse(event.data);
+      appendChat(data.chat_history);
+      if (data.active_peers) {
+        renderPeers(data.active_peers);
+      }
+    };
+
+    // If the server refuses the stream (too many open), poll /updates instead.
+    stream.onerror = function() {
+      if (stream.readyState !== EventSource.CLOSED) {
+        return;
+      }
+      function fetchUpdates() {
+        fetch('{{ url_for("updates") }}')
+          .then(response => response.json())
+          .then(data => {
+            appendChat(data.chat_history);
+            renderPeers(data.active_peers);
+          })
+          .catch(err => console.error("Error fetching updates:", err));
+      }
+      setInterval(fetchUpdates, 3000);
+      fetchUpdates();
+    };
   </script>
 </body>
 </html>
 """
 
+# Compile the page once; render_template_string would re-parse it on every request.
+index_template = app.jinja_env.from_string(html_template)
+
+# The page has no per-request content, so it is rendered and gzipped once, on
+# the first request (url_for needs a request context), and served from memory.
+index_page = None
+
+def get_index_page():
+    """Returns the rendered index page as (html, gzipped html) bytes."""
+    global index_page
+    if index_page is None:
+        html = render_template(index_template).encode()
+        index_page = (html, gzip.compress(html, 9))
+    return index_page
+
 @app.route("/")
 def index():
-    return render_template_string(html_template)
+    html, html_gz = get_index_page()
+    if request.accept_encodings["gzip"]:
+        response = Response(html_gz, mimetype="text/html")
+        response.headers["Content-Encoding"] = "gzip"
+    else:
+        response = Response(html, mimetype="text/html")
+    response.vary.add("Accept-Encoding")
+    return response
 
 @app.route("/quit", methods=["POST"])
 def quit_app():
@@ -550,7 +1007,7 @@ def connect():
     except ValueError:
         return redirect(url_for('index'))
     
-    threading.Thread(target=connect_to_peer, args=(peer_ip, peer_port), daemon=True).start()
+    run_on_peer_loop(connect_to_peer(peer_ip, peer_port))
     return redirect(url_for('index'))
 
 @app.route("/send", methods=["POST"])
@@ -571,8 +1028,8 @@ def send():
 
     # Add local message to chat history.
     add_chat_message(team_name, message)
-    # Send message to target peer
-    send_message(ip, port, f"{team_name}: {message}")
+    # Hand the send to the peer event loop; the request does not wait for it.
+    run_on_peer_loop(send_message(ip, port, f"{team_name}: {message}"))
     return redirect(url_for('index'))
 
 @app.route("/updates", methods=["GET"])
@@ -580,17 +1037,62 @@ def updates():
     """
     Return JSON with current chat history and active peers.
     """
-    with chat_lock:
-        chat = list(chat_history)
-    with peers_lock:
-        connected = [f"{ip}:{port}" for (ip, port) in active_peers.keys()]
-    return jsonify({
-        "chat_history": chat,
-        "active_peers": connected
-    })
+    return Response(updates_cache.get_bytes(), mimetype="application/json")
+
+def event_stream(last_seq, client_disconnected):
+    """
+    Yields Server-Sent Events: chat messages newer than last_seq, plus the
+    peer list on the first event and whenever it changes. A keep-alive comment
+    is sent when nothing happens for STREAM_KEEPALIVE seconds.
+    Stops as soon as client_disconnected() reports that the browser has gone,
+    so a closed tab frees its stream slot within STREAM_KEEPALIVE seconds.
+    """
+    last_peers = None
+    while True:
+        with updates_cond:
+            updates_cond.wait_for(
+                lambda: (chat_history and chat_history[-1]['seq'] > last_seq)
+                or active_peers.display is not last_peers,
+                timeout=STREAM_KEEPALIVE)
+        if client_disconnected():
+            return
+        chat = [msg for msg in list(chat_history) if msg['seq'] > last_seq]
+        peers = active_peers.display
+        if not chat and peers is last_peers:
+            yield ": keep-alive\n\n"
+            continue
+        event = {"chat_history": chat}
+        if peers is not last_peers:
+            event["active_peers"] = peers
+            last_peers = peers
+        if chat:
+            last_seq = chat[-1]['seq']
+        yield f"id: {last_seq}\ndata: {dump_json(event).decode()}\n\n"
+
+@app.route("/stream", methods=["GET"])
+def stream():
+    """
+    Push chat messages and peer-list changes to the browser as Server-Sent Events.
+    At most MAX_STREAMS streams are open at once; beyond that the request is
+    refused with a 503 and the page falls back to polling /updates.
+    """
+    if not stream_slots.acquire(blocking=False):
+        return Response("Too many open streams", status=503, mimetype="text/plain")
+    try:
+        last_seq = int(request.headers.get("Last-Event-ID", -1))
+    except ValueError:
+        last_seq = -1
+    # waitress reports a closed connection through this hook (it needs
+    # channel_request_lookahead, see main()); other servers only notice when
+    # a write fails.
+    client_disconnected = request.environ.get("waitress.client_disconnected", lambda: False)
+    response = Response(event_stream(last_seq, client_disconnected), mimetype="text/event-stream",
+                        headers={"Cache-Control": "no-cache"})
+    response.call_on_close(stream_slots.release)
+    return response
 
 def main():
-    global my_listen_port, team_name
+    global my_listen_port, team_name, peer_loop
 
     # Get team name and listening port from the user.
     team_name = input("Enter your team name: ").strip()
@@ -604,47 +1106,43 @@ def main():
     print(f"[INFO] Your local IP address is: {local_ip}")
     print("[INFO] Share this IP and your port with peers for connecting externally.")
 
-    # Set up the listening socket for peer connections.
-    listen_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    log_listener = start_logging()
+
+    # Start the peer event loop in its own thread. It sleeps in the selector
+    # (epoll on Linux) until a peer connects or sends data; run_on_peer_loop()
+    # and the shutdown below wake it through the loop's self-pipe.
+    peer_loop = asyncio.SelectorEventLoop(selectors.DefaultSelector())
+    loop_thread = threading.Thread(target=peer_loop.run_forever, daemon=True)
+    loop_thread.start()
+
+    # Set up the listening server for peer connections.
     try:
-        listen_socket.bind(("0.0.0.0", my_listen_port))
+        server = run_on_peer_loop(serve()).result()
     except Exception as e:
         print(f"[ERROR] Could not bind to port {my_listen_port}: {e}")
         sys.exit(1)
-
-    listen_socket.listen(5)
     print(f"[INFO] Peer server listening on port {my_listen_port}...")
 
-    # Start the peer server thread.
-    server = threading.Thread(target=server_thread, args=(listen_socket,), daemon=True)
-    server.start()
-
-    # Give the server thread a moment to start.
-    time.sleep(2)
+    # Connect to the mandatory peers and greet them in the background (optional).
+    peer_loop.call_soon_threadsafe(spawn_task, send_mandatory_messages())
 
-    # Send mandatory messages (optional).
-    send_mandatory_messages()
-
-    # Now start the Flask web interface (running on port 5000).
+    # Now start the Flask web interface (running on port 5000) on waitress's
+    # thread pool, falling back to Flask's development server if waitress is missing.
     try:
-        app.run(host="0.0.0.0", port=5000, debug=False, use_reloader=False)
+        if waitress_serve is not None:
+            # channel_request_lookahead keeps reading each connection while its
+            # request runs, so /stream can tell when the browser has gone.
+            waitress_serve(app, host="0.0.0.0", port=5000, threads=WEB_THREADS,
+                           channel_request_lookahead=1)
+        else:
+            app.run(host="0.0.0.0", port=5000, debug=False, use_reloader=False, threaded=True)
     except KeyboardInterrupt:
         print("Shutting down...")
     finally:
-        shutdown_event.set()
-        with peers_lock:
-            for peer, sock in list(active_peers.items()):
-                try:
-                    sock.close()
-                except Exception:
-                    pass
-            active_peers.clear()
-        try:
-            listen_socket.close()
-        except Exception:
-            pass
-        server.join(timeout=2)
+        run_on_peer_loop(close_all_peers(server)).result(timeout=2)
+        peer_loop.call_soon_threadsafe(peer_loop.stop)
+        loop_thread.join(timeout=2)
+        log_listener.stop()
         print("Goodbye!")
 
 if __name__ == "__main__":